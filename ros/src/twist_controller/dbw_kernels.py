@@ -0,0 +1,77 @@
+import math
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def cross_track_error(xy, px, py):
+    # Waypoints are moved to a frame with origin on the first one and the x axis
+    # pointing to waypoint 15, a cubic is fitted to them and the offset of the
+    # car position (px, py) from that cubic is returned
+    num_wp = xy.shape[0]
+    ox = xy[0, 0]
+    oy = xy[0, 1]
+    offset = 15
+    angle = math.atan2(xy[offset, 1] - oy, xy[offset, 0] - ox)
+    c = math.cos(angle)
+    s = math.sin(angle)
+
+    # Power sums of x up to x^6 and of x^k * y up to k = 3 for the normal equations
+    sum_x = np.zeros(7)
+    sum_xy = np.zeros(4)
+    for i in range(num_wp):
+        dx = xy[i, 0] - ox
+        dy = xy[i, 1] - oy
+        rx = c * dx + s * dy
+        ry = c * dy - s * dx
+        xk = 1.
+        for k in range(7):
+            sum_x[k] += xk
+            if k < 4:
+                sum_xy[k] += xk * ry
+            xk *= rx
+
+    # Augmented normal matrix, coefficients ordered from x^3 down to x^0
+    a = np.empty((4, 5))
+    for r in range(4):
+        for col in range(4):
+            a[r, col] = sum_x[6 - r - col]
+        a[r, 4] = sum_xy[3 - r]
+
+    # Gaussian elimination with partial pivoting
+    for k in range(4):
+        pivot = k
+        for r in range(k + 1, 4):
+            if abs(a[r, k]) > abs(a[pivot, k]):
+                pivot = r
+        if pivot != k:
+            for col in range(5):
+                tmp = a[k, col]
+                a[k, col] = a[pivot, col]
+                a[pivot, col] = tmp
+        for r in range(k + 1, 4):
+            f = a[r, k] / a[k, k]
+            for col in range(k, 5):
+                a[r, col] -= f * a[k, col]
+
+    coefficients = np.empty(4)
+    for r in range(3, -1, -1):
+        acc = a[r, 4]
+        for col in range(r + 1, 4):
+            acc -= a[r, col] * coefficients[col]
+        coefficients[r] = acc / a[r, r]
+
+    # Transform the current pose of the car to be in the car's coordinate system
+    dx = px - ox
+    dy = py - oy
+    rotated_pose_x = c * dx + s * dy
+    rotated_pose_y = c * dy - s * dx
+
+    expected_y_value = ((coefficients[0] * rotated_pose_x + coefficients[1]) * rotated_pose_x
+                        + coefficients[2]) * rotated_pose_x + coefficients[3]
+    return expected_y_value - rotated_pose_y
+
+
+def warmup():
+    # compile (or load from the numba cache) the cross track error fit
+    cross_track_error(np.arange(40.).reshape(20, 2), 0., 0.)
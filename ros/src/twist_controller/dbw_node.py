@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import math
+import threading
 import numpy as np
 from dbw_mkz_msgs.msg import ThrottleCmd, SteeringCmd, BrakeCmd, SteeringReport
 from geometry_msgs.msg import PoseStamped
@@ -9,8 +10,9 @@ import rospy
 from std_msgs.msg import Bool
 from styx_msgs.msg import Lane
 from twist_controller import Controller
+from dbw_kernels import cross_track_error, warmup
 
-
+SETPOINT_TIMEOUT = 0.5   # seconds without /twist_cmd before the controller is reset
 
 
 class DBWNode(object):
@@ -49,14 +51,29 @@ class DBWNode(object):
         self.brake_pub = rospy.Publisher('/vehicle/brake_cmd',
                                          BrakeCmd, queue_size=1)
 
+        # Command messages are reused, only the command values change between publishes
+        self.tcmd = ThrottleCmd()
+        self.tcmd.enable = True
+        self.tcmd.pedal_cmd_type = ThrottleCmd.CMD_PERCENT
+
+        self.scmd = SteeringCmd()
+        self.scmd.enable = True
+
+        self.bcmd = BrakeCmd()
+        self.bcmd.enable = True
+        self.bcmd.pedal_cmd_type = BrakeCmd.CMD_TORQUE
+
         self.controller = Controller(**config)
 
+        warmup()
+
         self.is_dbw_enabled = False
         self.current_velocity = None
         self.proposed_velocity = None
         self.final_waypoints = None
         self.current_pose = None
-        self.previous_loop_time = rospy.get_rostime()
+        self.previous_control_time = None
+        self.control_lock = threading.Lock()
         # Subscribers
         self.twist_sub = rospy.Subscriber('/twist_cmd', TwistStamped, self.twist_message_callback, queue_size=1)
 
@@ -67,94 +84,83 @@ class DBWNode(object):
         self.final_wp_sub = rospy.Subscriber('final_waypoints', Lane, self.final_waypoints_cb, queue_size=1)
 
         self.pose_sub = rospy.Subscriber('/current_pose', PoseStamped, self.current_pose_cb, queue_size=1)
-        self.loop()
+
+        # Control runs on each new /twist_cmd, the timer only guards against a stalled setpoint stream
+        self.watchdog_timer = rospy.Timer(rospy.Duration(SETPOINT_TIMEOUT), self.watchdog)
+        rospy.spin()
 
     def get_xy_from_waypoints(self, waypoints):
 
-        return list(map(lambda waypoint: [waypoint.pose.pose.position.x, waypoint.pose.pose.position.y], waypoints))
+        xy = np.empty((len(waypoints), 2), dtype=np.float64)
+        for i, waypoint in enumerate(waypoints):
+            position = waypoint.pose.pose.position
+            xy[i, 0] = position.x
+            xy[i, 1] = position.y
+        return xy
 
 
     def get_cross_track_error(self, final_waypoints, current_pose):
 
-        origin = final_waypoints[0].pose.pose.position
-
-        waypoints_matrix = self.get_xy_from_waypoints(final_waypoints)
-
-
-        shifted_matrix = waypoints_matrix - np.array([origin.x, origin.y])
-
-
-        offset = 15
-        angle = np.arctan2(shifted_matrix[offset, 1], shifted_matrix[offset, 0])
-        rotation_matrix = np.array([
-                [np.cos(angle), -np.sin(angle)],
-                [np.sin(angle), np.cos(angle)]
-            ])
+        xy = self.get_xy_from_waypoints(final_waypoints)
+        position = current_pose.pose.position
+        return cross_track_error(xy, position.x, position.y)
 
-        rotated_matrix = np.dot(shifted_matrix, rotation_matrix)
+    def control_step(self):
 
-
-        degree = 3
-        coefficients = np.polyfit(rotated_matrix[:, 0], rotated_matrix[:, 1], degree)
-
-        # Transform the current pose of the car to be in the car's coordinate system
-        shifted_pose = np.array([current_pose.pose.position.x - origin.x, current_pose.pose.position.y - origin.y])
-        rotated_pose = np.dot(shifted_pose, rotation_matrix)
-
-        expected_y_value = np.polyval(coefficients, rotated_pose[0])
-        actual_y_value = rotated_pose[1]
-
-        return expected_y_value - actual_y_value
-
-    def loop(self):
-        # rate 50 Hz
-        rate = rospy.Rate(50)
-        while not rospy.is_shutdown():
-
-            if (self.current_velocity is not None) and (self.proposed_velocity is not None) and (self.final_waypoints is not None):
+        # the watchdog timer thread may reset the controller, keep it out of a running step
+        with self.control_lock:
+            current_velocity = self.current_velocity
+            proposed_velocity = self.proposed_velocity
+            final_waypoints = self.final_waypoints
+            if (current_velocity is not None) and (proposed_velocity is not None) and (final_waypoints is not None):
                 # current time
                 current_time = rospy.get_rostime()
-                ros_duration = current_time - self.previous_loop_time
+                previous_control_time = self.previous_control_time
+                self.previous_control_time = current_time
+                if previous_control_time is None:
+                    # first setpoint after start or a watchdog reset, no valid duration yet
+                    return
+                ros_duration = current_time - previous_control_time
                 duration_in_seconds = ros_duration.secs + (1e-9 * ros_duration.nsecs)
 
-                self.previous_loop_time = current_time
-
-                current_linear_velocity = self.current_velocity.twist.linear.x
-                target_linear_velocity = self.proposed_velocity.twist.linear.x
+                current_linear_velocity = current_velocity.twist.linear.x
+                proposed_twist = proposed_velocity.twist
+                target_linear_velocity = proposed_twist.linear.x
 
-                target_angular_velocity = self.proposed_velocity.twist.angular.z
-                cross_track_error = self.get_cross_track_error(self.final_waypoints, self.current_pose)
+                target_angular_velocity = proposed_twist.angular.z
+                cross_track_error = self.get_cross_track_error(final_waypoints, self.current_pose)
 
                 throttle, brake, steering = self.controller.control(target_linear_velocity,
                                                                     target_angular_velocity,
                                                                     current_linear_velocity, cross_track_error, duration_in_seconds)
 
-                if not self.is_dbw_enabled or \
-                         abs(self.current_velocity.twist.linear.x) < 1e-5 and \
-                         abs(self.proposed_velocity.twist.linear.x) < 1e-5:
+                is_dbw_enabled = self.is_dbw_enabled
+                if not is_dbw_enabled or \
+                         abs(current_linear_velocity) < 1e-5 and \
+                         abs(target_linear_velocity) < 1e-5:
                     self.controller.reset()
 
-                if self.is_dbw_enabled:
+                if is_dbw_enabled:
                     self.publish(throttle, brake, steering)
-            rate.sleep()
+
+    def watchdog(self, event):
+        # reset the controller if /twist_cmd stopped arriving
+        with self.control_lock:
+            previous_control_time = self.previous_control_time
+            if previous_control_time is not None and \
+                    rospy.get_rostime() - previous_control_time > rospy.Duration(SETPOINT_TIMEOUT):
+                self.controller.reset()
+                self.previous_control_time = None
 
     def publish(self, throttle, brake, steer):
-        tcmd = ThrottleCmd()
-        tcmd.enable = True
-        tcmd.pedal_cmd_type = ThrottleCmd.CMD_PERCENT
-        tcmd.pedal_cmd = throttle
-        self.throttle_pub.publish(tcmd)
-
-        scmd = SteeringCmd()
-        scmd.enable = True
-        scmd.steering_wheel_angle_cmd = steer
-        self.steer_pub.publish(scmd)
-
-        bcmd = BrakeCmd()
-        bcmd.enable = True
-        bcmd.pedal_cmd_type = BrakeCmd.CMD_TORQUE
-        bcmd.pedal_cmd = brake
-        self.brake_pub.publish(bcmd)
+        self.tcmd.pedal_cmd = throttle
+        self.throttle_pub.publish(self.tcmd)
+
+        self.scmd.steering_wheel_angle_cmd = steer
+        self.steer_pub.publish(self.scmd)
+
+        self.bcmd.pedal_cmd = brake
+        self.brake_pub.publish(self.bcmd)
 
     def twist_message_callback(self, message):
         """
@@ -174,6 +180,7 @@ class DBWNode(object):
                 float64 z
         """
         self.proposed_velocity = message
+        self.control_step()
 
     def current_velocity_callback(self, message):
         """
@@ -3,32 +3,41 @@ import rospy
 from geometry_msgs.msg import PoseStamped
 from styx_msgs.msg import Lane, Waypoint
 from std_msgs.msg import Int32
-import math
+import numpy as np
+from scipy.spatial import cKDTree
+from waypoint_updater_kernels import find_nearest, warmup
 
 # Implentation parameters
 LOOKAHEAD_WPS = 100
 WP_PUBLISH_RATE = 20
 
 max_local_dist = 20.0
-light_change_pub = True
 
 class WaypointUpdater(object):
     def __init__(self):
         rospy.init_node('waypoint_updater')
 
+        warmup()
+
         # Subscribers and Publisher
         rospy.Subscriber('/current_pose', PoseStamped, self.pose_cb)
         self.base_wp_sub = rospy.Subscriber('/base_waypoints', Lane, self.waypoints_cb)
         rospy.Subscriber('/traffic_waypoint', Int32, self.traffic_cb)
-        self.final_waypoints_pub = rospy.Publisher('final_waypoints', Lane, queue_size=1)
+        self.final_waypoints_pub = rospy.Publisher('final_waypoints', Lane, queue_size=1, latch=True)
 
         # State variables
         self.base_waypoints = []
         self.original_wpvel = []
+        self._modified_wps = set()
+        self._wp_xy = None
+        self._kdtree = None
+        self._cumdist = None
         self.next_waypoint = None
         self.current_pose = None
         self.redlight_wp = None
         self.msg_seq = 0
+        self._last_publish_state = None
+        self._lookahead_range = np.arange(LOOKAHEAD_WPS, dtype=np.int64)
 
         # params
         self.stop_on_red = rospy.get_param('~stop_on_red', True)      # Enable/disable stopping on red lights
@@ -40,6 +49,7 @@ class WaypointUpdater(object):
             self.accel = max(rospy.get_param('/dbw_node/decel_limit') / 2, self.accel)
         except KeyError:
             pass
+        self._brake_gain = 2*abs(self.accel)   # v^2 = 2|a|d
 
         rate = rospy.Rate(WP_PUBLISH_RATE)
         while not rospy.is_shutdown():
@@ -55,42 +65,28 @@ class WaypointUpdater(object):
             return False
 
         # Get car vars
-        x_carpos = self.current_pose.position.x
-        y_carpos = self.current_pose.position.y
-        theta_carpos = math.atan2(self.current_pose.orientation.y, self.current_pose.orientation.x)
-
+        position = self.current_pose.position
+        x_carpos = position.x
+        y_carpos = position.y
 
         # look for next_waypint 
 
-        wp = None
-        dist = 500000
-
-        if self.next_waypoint:
-            idx_offset = self.next_waypoint
-            full_search = False
-        else:
-            idx_offset = 0
-            full_search = True
-        num_base_wp = len(self.base_waypoints)
-
-        for i in range(num_base_wp):
-            idx = (i + idx_offset)%(num_base_wp)
-            wp_x = self.base_waypoints[idx].pose.pose.position.x
-            wp_y = self.base_waypoints[idx].pose.pose.position.y
-            wp_d = math.sqrt((x_carpos - wp_x)**2 + (y_carpos - wp_y)**2)
-
-            if wp_d < dist:
-                dist = wp_d
-                wp = idx
-            elif not full_search:
-                if dist < max_local_dist:
-                    # we found it
-                    break;
-                else:
-                    full_search = True
-
-        if wp is None:
-            return False
+        wp_xy = self._wp_xy
+        next_waypoint = self.next_waypoint
+        wp = -1
+        if next_waypoint:
+            wp = find_nearest(wp_xy, x_carpos, y_carpos, next_waypoint, max_local_dist)
+
+        if wp < 0:
+            # full search
+            _, wp = self._kdtree.query((x_carpos, y_carpos))
+            # take the following waypoint if the car is already past the nearest one
+            wp_next = (wp + 1) % len(wp_xy)
+            wp_x, wp_y = wp_xy[wp]
+            next_x, next_y = wp_xy[wp_next]
+            if (next_x - wp_x)*(x_carpos - wp_x) + (next_y - wp_y)*(y_carpos - wp_y) > 0:
+                wp = wp_next
+            wp = int(wp)
 
         self.next_waypoint = wp
         return True
@@ -108,24 +104,29 @@ class WaypointUpdater(object):
 
         if self.next_wpUpdate():
 
-            num_base_wp = len(self.base_waypoints)
+            # final waypoints only depend on these, skip republishing an identical lane
+            publish_state = (self.next_waypoint, self.redlight_wp)
+            if publish_state == self._last_publish_state:
+                return
+            self._last_publish_state = publish_state
+
+            base_waypoints = self.base_waypoints
+            num_base_wp = len(base_waypoints)
             last_base_wp = num_base_wp-1
-            waypoint_idx = [idx % num_base_wp for idx in range(self.next_waypoint,self.next_waypoint+LOOKAHEAD_WPS)]
-            final_waypoints = [self.base_waypoints[wp] for wp in waypoint_idx]
+            waypoint_idx = (self.next_waypoint + self._lookahead_range) % num_base_wp
+            final_waypoints = [base_waypoints[wp] for wp in waypoint_idx.tolist()]
 
+            self.restore_velocities()
             if self.stop_on_red:
-                self.restore_velocities(waypoint_idx)
-                try:
-                    red_idx = waypoint_idx.index(self.redlight_wp)
-                    self.deaccel(final_waypoints, red_idx, self.stop_distance)
-                except ValueError:
-                    red_idx = None
+                redlight_wp = self.redlight_wp
+                if redlight_wp is not None:
+                    red_idx = np.flatnonzero(waypoint_idx == redlight_wp)
+                    if len(red_idx):
+                        self.deaccel(final_waypoints, waypoint_idx, red_idx[0], self.stop_distance)
             if self.force_stop_on_last_waypoint or self.original_wpvel[-1] < 1e-5:
-                try:
-                    last_wp_idx = waypoint_idx.index(last_base_wp)
-                    self.deaccel(final_waypoints, last_wp_idx, 0)
-                except ValueError:
-                    pass
+                last_wp_idx = np.flatnonzero(waypoint_idx == last_base_wp)
+                if len(last_wp_idx):
+                    self.deaccel(final_waypoints, waypoint_idx, last_wp_idx[0], 0)
 
             self.msgPublish(final_waypoints)
 
@@ -137,7 +138,13 @@ class WaypointUpdater(object):
 
         waypoints = msg.waypoints
         num_wp = len(waypoints)
-        if self.base_waypoints and self.next_waypoint is not None: 
+
+        # same track sent again (possibly with new velocities), the position caches stay valid
+        same_track = self._wp_xy is not None and self.base_waypoints and num_wp == len(self.base_waypoints) and \
+            self.sameWP(self.base_waypoints[0], waypoints[0]) and \
+            self.sameWP(self.base_waypoints[-1], waypoints[-1])
+
+        if not same_track and self.base_waypoints and self.next_waypoint is not None: 
 
             if not self.sameWP(self.base_waypoints[self.next_waypoint],
                                          waypoints[self.next_waypoint]):
@@ -147,7 +154,20 @@ class WaypointUpdater(object):
         else:
             pass
 
-        self.original_wpvel = [self.get_wpVel(waypoints, idx) for idx in range(num_wp)]
+        self.original_wpvel = np.array([self.get_wpVel(waypoints, idx) for idx in range(num_wp)])
+        self._modified_wps = set()
+        self._last_publish_state = None
+
+        if not same_track:
+            self._wp_xy = np.asarray([[wp.pose.pose.position.x, wp.pose.pose.position.y] for wp in waypoints],
+                                     dtype=np.float64)
+            self._kdtree = cKDTree(self._wp_xy)
+
+            # cumulative path length, closing segment from the last waypoint back to the first included
+            wp_z = np.asarray([wp.pose.pose.position.z for wp in waypoints], dtype=np.float64)
+            wp_xyz = np.column_stack((self._wp_xy, wp_z))
+            seg = np.diff(np.vstack((wp_xyz, wp_xyz[:1])), axis=0)
+            self._cumdist = np.concatenate(([0.], np.cumsum(np.sqrt((seg*seg).sum(axis=1)))))
 
         self.base_waypoints = waypoints
 
@@ -157,61 +177,58 @@ class WaypointUpdater(object):
 
     def traffic_cb(self, msg):
 
-        prev_red_light_waypoint = self.redlight_wp
+        # picked up by the next updatePublish of the main loop
         self.redlight_wp = msg.data if msg.data >= 0 else None
-        
-        if prev_red_light_waypoint != self.redlight_wp:
-            if light_change_pub:
-                self.updatePublish()
 
     def obstacle_cb(self, msg):
         pass
 
-    def restore_velocities(self, indexes):
-        for idx in indexes:
-            self.set_wpVel(self.base_waypoints, idx, self.original_wpvel[idx])
+    def restore_velocities(self):
+        # only waypoints lowered by deaccel since the last restore differ from the originals
+        base_waypoints = self.base_waypoints
+        original_wpvel = self.original_wpvel
+        for idx in self._modified_wps:
+            base_waypoints[idx].twist.twist.linear.x = float(original_wpvel[idx])
+        self._modified_wps.clear()
 
-    def deaccel(self, waypoints, stop_index, stop_distance):
+    def deaccel(self, waypoints, waypoint_idx, stop_index, stop_distance):
 
         if stop_index <= 0:
             return
 
-        dist = self.distance(waypoints, 0, stop_index)
-        step = dist / stop_index
-        vel = 0.
-        d = 0.
+        # path length from the first waypoint to each of the others
+        first_wp = waypoint_idx[0]
+        along = self._cumdist[waypoint_idx] - self._cumdist[first_wp]
+        along[waypoint_idx < first_wp] += self._cumdist[-1]
+
+        # distance left to the stop point, and the velocity allowed there
+        d = np.maximum(0., along[stop_index] - along)
+        vels = np.where(d > self.stop_distance,
+                        np.sqrt(self._brake_gain*np.maximum(0., d - stop_distance)), 0.)
 
-        for idx in reversed(range(len(waypoints))):
-            if idx < stop_index:
-                d += step
-                if d > self.stop_distance:
-                    vel = math.sqrt(2*abs(self.accel)*(d-stop_distance))
-            if vel < self.get_wpVel(waypoints, idx):
-                self.set_wpVel(waypoints, idx, vel)
+        modified_wps = self._modified_wps
+        for wp, idx, vel in zip(waypoints, waypoint_idx.tolist(), vels.tolist()):
+            linear = wp.twist.twist.linear
+            if vel < linear.x:
+                linear.x = vel
+                modified_wps.add(idx)
 
 
     def get_wpVel(self, waypoints, waypoint):
         return waypoints[waypoint].twist.twist.linear.x
 
-    def set_wpVel(self, waypoints, waypoint, velocity):
-        waypoints[waypoint].twist.twist.linear.x = velocity
-
-    def distance(self, waypoints, wp1, wp2):
-        dist = 0
-        dl = lambda a, b: math.sqrt((a.x-b.x)**2 + (a.y-b.y)**2  + (a.z-b.z)**2)
-        for i in range(wp1, wp2+1):
-            dist += dl(waypoints[wp1].pose.pose.position, waypoints[i].pose.pose.position)
-            wp1 = i
-        return dist
-
     def sameWP(self, wp1, wp2, max_d=0.5, max_v=0.5):
 
         # dist
-        dl = lambda a, b: math.sqrt((a.x-b.x)**2 + (a.y-b.y)**2  + (a.z-b.z)**2)
-        # dist difference
-        distdif = dl(wp1.pose.pose.position, wp2.pose.pose.position)
-
-        if distdif < max_d:
+        a = wp1.pose.pose.position
+        b = wp2.pose.pose.position
+        dx = a.x - b.x
+        dy = a.y - b.y
+        dz = a.z - b.z
+        # squared dist difference, compared against the squared threshold
+        distdif2 = dx*dx + dy*dy + dz*dz
+
+        if distdif2 < max_d*max_d:
            return True
         return False
 
@@ -0,0 +1,29 @@
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def find_nearest(xy, x, y, idx_offset, max_local_dist):
+    # Scan forward from idx_offset up to the first distance increase; -1 if the
+    # local minimum found is farther than max_local_dist
+    num_wp = xy.shape[0]
+    best = -1
+    best_d2 = 1e18
+    for i in range(num_wp):
+        idx = (i + idx_offset) % num_wp
+        dx = xy[idx, 0] - x
+        dy = xy[idx, 1] - y
+        d2 = dx*dx + dy*dy
+        if d2 < best_d2:
+            best_d2 = d2
+            best = idx
+        else:
+            break
+    if best_d2 < max_local_dist*max_local_dist:
+        return best
+    return -1
+
+
+def warmup():
+    # compile (or load from the numba cache) the nearest waypoint search
+    find_nearest(np.zeros((2, 2)), 0., 0., 0, 1.)